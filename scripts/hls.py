@@ -1,39 +1,74 @@
 # hls.py
 # Code to interface with the Vitis HLS tool
 import os
+import io
+import sys
+import shutil
 import hls_reports
 import ast
+import json
 import math
 import subprocess
+import concurrent.futures
 import network_gen
 import utils
 
+# Returns the directory that the reports for an implementation are kept in
+# after synthesis.
+def get_report_dir(impl_path):
+   return os.path.join(impl_path, 'report')
+
+# Prints a status message from synthesize_layer. The message and its newline are written
+# together and flushed right away, so lines from syntheses running in parallel worker
+# processes don't get mixed together or held back in the log.
+def print_synth_status(msg):
+   print(msg + '\n', end='', flush=True)
+
 # Given a layer name and a path to an implementation of that layer,
 # calls vitis_hls to synthesize it.
 def synthesize_layer(layer_name, impl_path):
-   print("Synthesizing layer implementation at {}".format(impl_path), flush=True)
-   cwd = os.getcwd()
-   os.chdir(impl_path)
+   print_synth_status("Synthesizing layer implementation at {}".format(impl_path))
    # Sometimes Vitis HLS just gets stuck before synthesis even begins. This appears to be
    # random and does not regularly reproduce. So put a conservatively large timeout (30 minutes)
    # on it, and if it fails, try it again once.
-   cmd = 'timeout 30m vitis_hls -f {}.tcl > /dev/null'.format(layer_name)
-   exitcode = os.WEXITSTATUS(os.system(cmd))
+   # The tool is run with its working directory set to the implementation directory rather than
+   # changing our own working directory. This function never touches process-wide state, so
+   # multiple syntheses can safely run at the same time.
+   cmd = ['timeout', '30m', 'vitis_hls', '-f', '{}.tcl'.format(layer_name)]
+   exitcode = subprocess.run(cmd, cwd=impl_path, stdout=subprocess.DEVNULL).returncode
    if exitcode == 124:
-      print("Timed out. Trying again once.")
-      exitcode = os.WEXITSTATUS(os.system(cmd))
-   # Copy the report directory to the implementation root directory,
+      print_synth_status("Synthesis at {} timed out. Trying again once.".format(impl_path))
+      exitcode = subprocess.run(cmd, cwd=impl_path, stdout=subprocess.DEVNULL).returncode
+   # Move the report directory to the implementation root directory,
    # and delete everything else generated by the HLS tool. This is to save
    # disk space since the HLS tool can generate several MB worth of data
    # per implementation. All we really want is the reports.
-   hls_proj_dir = os.path.join(".", '{}_prj'.format(layer_name))
+   # Both directories are on the same filesystem, so the move is just a rename.
+   hls_proj_dir = os.path.join(impl_path, '{}_prj'.format(layer_name))
    old_report_dir = os.path.join(hls_proj_dir, 'solution1/syn/report')
-   os.system('cp -R {} .'.format(old_report_dir))
-   os.system('rm -rf {}'.format(hls_proj_dir))
-   os.chdir(cwd)
+   report_dir = get_report_dir(impl_path)
+   if os.path.isdir(old_report_dir):
+      # Replace the reports from any previous synthesis of this implementation
+      shutil.rmtree(report_dir, ignore_errors=True)
+      shutil.move(old_report_dir, report_dir)
+   shutil.rmtree(hls_proj_dir, ignore_errors=True)
    if exitcode != 0:
       raise Exception('Vitis HLS failed with exit code {} at {}'.format(exitcode, impl_path))
-   print("Done.", flush=True)
+   print_synth_status("Done synthesizing {}.".format(impl_path))
+
+
+# Returns the number of syntheses to run in parallel for a given number of implementations.
+# Defaults to the number of CPUs, but can be limited with the SCALE_CNN_JOBS environment
+# variable, e.g. to match the number of available Vitis HLS license seats.
+def get_num_synth_jobs(num_impls):
+   jobs = os.getenv('SCALE_CNN_JOBS')
+   if jobs is None:
+      max_jobs = os.cpu_count() or 1
+   elif jobs.strip().isdigit() and int(jobs) > 0:
+      max_jobs = int(jobs)
+   else:
+      raise Exception('SCALE_CNN_JOBS must be a positive integer, got "{}".'.format(jobs))
+   return max(1, min(num_impls, max_jobs))
 
 
 # Calculate the "true" latency of the function
@@ -42,14 +77,18 @@ def synthesize_layer(layer_name, impl_path):
 # pipeline, we can easily calculate the true latency by adding the number of "skipped"
 # iterations and multiplying it by the dataflow pipeline's II.
 def CalcTrueLatency(layer_spec, impl_spec, report_latency, dataflow_ii):
+   # Everything here is integer arithmetic so the result is exact. The output channel
+   # scale factor is always chosen as a factor of the output channels.
    ltype = layer_spec['layer_type']
    ochans = layer_spec['intermediate_chans' if ltype == 'conv-conv' else 'output_chans']
-   true_iters  = layer_spec['output_height'] * layer_spec['output_width'] * \
-                 ochans / impl_spec['ochan_scale_factor']
-   if layer_spec['layer_type'] == 'conv-max':
+   ochan_sf = impl_spec['ochan_scale_factor']
+   if ochans % ochan_sf != 0:
+      raise Exception('Output channel scale factor {} does not divide {} output channels.'.format(ochan_sf, ochans))
+   true_iters  = layer_spec['output_height'] * layer_spec['output_width'] * (ochans // ochan_sf)
+   if ltype == 'conv-max':
       true_iters = true_iters * (layer_spec['pooling_factor'] ** 2)
    synth_iters = 10
-   return int(report_latency + (true_iters - synth_iters) * dataflow_ii)
+   return report_latency + (true_iters - synth_iters) * dataflow_ii
 
 
 # Parse and analyze the reports after synthesis of a layer completes.
@@ -74,7 +113,7 @@ def analyze_reports(layer_spec, impl, args):
 
    layer_name = layer_spec['layer_name']
    impl_dir = impl['dir']
-   report_dir = os.path.join(impl_dir, 'report')
+   report_dir = get_report_dir(impl_dir)
 
    # First we must read the top-level report
    # Then we need to read the reports for all of the sub-functions.
@@ -107,7 +146,7 @@ def analyze_reports(layer_spec, impl, args):
 
 # analyze_reports for AXI layers
 def analyze_reports_axi(layer_spec, layer_path, args):
-   report_dir = os.path.join(layer_path, 'report')
+   report_dir = get_report_dir(layer_path)
    top_level_rpt_filepath = os.path.join(report_dir, '{}_{}_top_csynth.xml'.format(layer_spec['name'], layer_spec['layer_type']))
    top_level_xml = hls_reports.read_report_xml(top_level_rpt_filepath)
    top_latency = hls_reports.GetWorstCaseLatency(top_level_xml)
@@ -122,74 +161,75 @@ REPORT_HEADER = '''
 ==========================================================='''
 
 def generate_layer_summary(layer_spec, summary_filepath, impl_results, printReport=True):
-   global REPORT_HEADER
-
    # First generate a CSV file that just contains (implementation directory, latency, cost)
    # This will be used when we are analyzing multiple layers for a network.
    csv_filepath = summary_filepath + ".csv"
+   csv_rows = "".join(f"{impl['dir']},{report_info['true_latency']},{report_info['cost_info']['total']}\n" \
+                      for impl, report_info in impl_results)
    with open(csv_filepath, 'w') as csv_file:
-      csv_file.write('ImplementationDir,Latency,Cost\n')
-      for impl, report_info in impl_results:
-         latency = report_info['true_latency']
-         cost    = report_info['cost_info']['total']
-         csv_file.write(",".join([impl['dir'], str(latency), str(cost)]))
-         csv_file.write('\n')
+      csv_file.write('ImplementationDir,Latency,Cost\n' + csv_rows)
 
    # Now generate the human-readable file summarizing the different implementations
    # For each implementation, show what the sub-functions are, and the latencies of each.
    # Point out which stage is the longest.
+   # The report is built up in memory and written to the file all at once.
    rpt_filepath = summary_filepath + ".txt"
-   with open(rpt_filepath, 'w') as rpt:
-      rpt.write(REPORT_HEADER.format(layer_spec['layer_name']))
-      for impl, report_info in impl_results:
-         rpt.write('\n\n')
-         # Implementation name and directory
-         rpt.write("Implementation: {}\n".format(impl['name']))
-         rpt.write("Directory: {}\n".format(impl['dir']))
-         # Report Info
-         # Total latency
-         true_latency = report_info['true_latency']
-         est_latency  = impl['estimated_latency']
-         latency_error = abs(est_latency - true_latency) / true_latency 
-         rpt.write("\nTotal latency (raw)  : {} cycles\n".format('{:,}'.format(report_info['latency'])))
-         rpt.write("Total latency (true) : {} cycles\n".format('{:,}'.format(true_latency)))
-         rpt.write("Estimated total latency: {} cycles\n".format('{:,}'.format(impl['estimated_latency'])))
-         rpt.write("Estimation error: {:.2%}\n\n".format(latency_error))
-         if latency_error > 0.05:
-            rpt.write("WARNING: Latency estimation error unexpectedly high. Check layer synthesis results.\n\n")
-         # Cost info
-         cost_info = report_info['cost_info']
-         rpt.write("Cost info:\n")
-         # Report each individual cost and the total
-         for cost_factor in cost_info:
-            if cost_factor != 'total':
-               rpt.write("{}: {:.2f}%\n".format(cost_factor, cost_info[cost_factor] * 100))
-         rpt.write("Total cost: {:.3f}\n\n".format(cost_info['total']))
-         # Subfunction latencies
-         rpt.write("Subfunction latencies:\n")
-         subfunctions = report_info['subfunctions']
-         for func in subfunctions:
-            rpt.write("{}: {} cycles\n".format(func['name'], func['latency']))
-         # And finally, report memory read bandwidth utilization
-         # Disabling this as the metric doesn't really make sense any more.
-         #rpt.write('\nMemory Read Bandwidth Utilization: {:.1f}%\n'.format(report_info['mbru'] * 100))
+   rpt = io.StringIO()
+   rpt.write(REPORT_HEADER.format(layer_spec['layer_name']))
+   for impl, report_info in impl_results:
+      name, impl_dir, est_latency = impl['name'], impl['dir'], impl['estimated_latency']
+      raw_latency, true_latency   = report_info['latency'], report_info['true_latency']
+      cost_info, subfunctions     = report_info['cost_info'], report_info['subfunctions']
+      rpt.write('\n\n')
+      # Implementation name and directory
+      rpt.write(f"Implementation: {name}\nDirectory: {impl_dir}\n")
+      # Report Info
+      # Total latency
+      latency_error = abs(est_latency - true_latency) / true_latency 
+      rpt.write(f"\nTotal latency (raw)  : {raw_latency:,} cycles\n"
+                f"Total latency (true) : {true_latency:,} cycles\n"
+                f"Estimated total latency: {est_latency:,} cycles\n"
+                f"Estimation error: {latency_error:.2%}\n\n")
+      if latency_error > 0.05:
+         rpt.write("WARNING: Latency estimation error unexpectedly high. Check layer synthesis results.\n\n")
+      # Cost info
+      rpt.write("Cost info:\n")
+      # Report each individual cost and the total
+      rpt.write("".join(f"{k}: {v * 100:.2f}%\n" for k, v in cost_info.items() if k != 'total'))
+      rpt.write(f"Total cost: {cost_info['total']:.3f}\n\n")
+      # Subfunction latencies
+      rpt.write("Subfunction latencies:\n")
+      rpt.write("".join(f"{func['name']}: {func['latency']} cycles\n" for func in subfunctions))
+      # And finally, report memory read bandwidth utilization
+      # Disabling this as the metric doesn't really make sense any more.
+      #rpt.write('\nMemory Read Bandwidth Utilization: {:.1f}%\n'.format(report_info['mbru'] * 100))
+   with open(rpt_filepath, 'w') as rpt_file:
+      rpt_file.write(rpt.getvalue())
 
    # Print the entire report to stdout and then print messages about the generated files.
    if printReport:
-      os.system('cat ' + rpt_filepath)
+      sys.stdout.write(rpt.getvalue())
    print("\n\nGenerated above report at {}".format(rpt_filepath))
    print("Generated CSV summary at {}\n".format(csv_filepath))
 
 
+# Parses one line of an implementation list file. Lists are written as JSON lines,
+# but lists generated by older versions of the tool contain Python dict literals.
+def parse_impl_list_line(line):
+   try:
+      return json.loads(line)
+   except json.JSONDecodeError:
+      return ast.literal_eval(line.rstrip('\n'))
+
 def read_layer_implementations(impl_list_path):
    # Read the file with the implementation paths to explore.
+   # The first line is the layer spec, and every line after it is one implementation.
    implementations = []
    layer_spec = {}
    with open(impl_list_path, 'r') as f:
-      lines = f.readlines()
-      layer_spec = ast.literal_eval(lines[0].rstrip('\n'))
-      for line in lines[1:]:
-         implementations.append(ast.literal_eval(line.rstrip('\n')))
+      layer_spec = parse_impl_list_line(f.readline())
+      for line in f:
+         implementations.append(parse_impl_list_line(line))
    return layer_spec, implementations
 
 # Top-level function called from scale-cnn.py to explore the different
@@ -203,18 +243,40 @@ def explore_layer_implementations(impl_list_path, args):
    layer_name = layer_spec['layer_name']
    print("Exploring {} layer implementations for {}.".format(len(implementations), layer_name))
 
-   implementation_results = []
-   # For each implementation...
-   for impl in implementations:
-      if not os.path.isdir(impl['dir']):
-         raise Exception('Invalid implementation path at {}'.format(impl_dir))
-      # Synthesize the layer
-      if not args.skip_synth:
-         synthesize_layer(layer_name, impl['dir'])
-      # Parse the reports to get performance and cost info
-      report_info = analyze_reports(layer_spec, impl, args)
-      implementation_results.append((impl, report_info))
-      
+   # Check all of the implementation directories up front so that a bad implementation list
+   # fails immediately rather than partway through hours of synthesis.
+   bad_dirs = [impl['dir'] for impl in implementations if not os.path.isdir(impl['dir'])]
+   if bad_dirs:
+      raise FileNotFoundError('Invalid implementation path(s): {}'.format(', '.join(bad_dirs)))
+
+   # Results are stored by index so the summary keeps the order of the implementation list,
+   # regardless of the order in which the syntheses finish.
+   implementation_results = [None] * len(implementations)
+   if args.skip_synth:
+      for i, impl in enumerate(implementations):
+         implementation_results[i] = (impl, analyze_reports(layer_spec, impl, args))
+   else:
+      # Each synthesis is an independent Vitis HLS run, so synthesize the implementations
+      # in parallel and parse the reports of each one as soon as it finishes.
+      num_jobs = get_num_synth_jobs(len(implementations))
+      print("Running up to {} syntheses in parallel.".format(num_jobs), flush=True)
+      with concurrent.futures.ProcessPoolExecutor(max_workers=num_jobs) as pool:
+         futures = {pool.submit(synthesize_layer, layer_name, impl['dir']): i \
+                    for i, impl in enumerate(implementations)}
+         try:
+            for future in concurrent.futures.as_completed(futures):
+               future.result() # Re-raises any synthesis failure
+               i = futures[future]
+               impl = implementations[i]
+               implementation_results[i] = (impl, analyze_reports(layer_spec, impl, args))
+         except BaseException:
+            # Stop on the first failure. Cancel the syntheses that have not started yet,
+            # otherwise leaving the with block would wait for all of them to run first.
+            # Syntheses already handed to a worker process still finish before the error is raised.
+            for f in futures:
+               f.cancel()
+            raise
+
    # Summarize the results
    summary_filename = '{}_implementations_summary'.format(layer_name)
    summary_filepath = os.path.join(os.path.dirname(impl_list_path), summary_filename)
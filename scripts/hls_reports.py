@@ -4,6 +4,11 @@ import re
 import xml.etree.ElementTree as ET
 import utils
 
+# Regular expressions used to parse the dataflow pipeline report.
+# Compiled once here since they are used on every line of every report.
+RPT_COLUMN_SEP_RE = re.compile(r'\s*\|\s*')
+ACCUM_STAGE_RE    = re.compile(r'accum_\d_\d')
+
 def read_report_xml(xml_report_filepath):
    tree = ET.parse(xml_report_filepath)
    return tree.getroot()
@@ -81,7 +86,7 @@ def GetCostInfo(layer_spec, report_xml, cost_func):
 # stage in the pipeline. Stages with a latency of 0 are not reported.
 def GetDataflowStageLatencies(dataflow_rpt_filepath):
    stages = []
-   stage_names = []
+   stage_names = set()
    with open(dataflow_rpt_filepath, 'r') as rpt:
       # Find the line with the word "Module" in it
       for line in rpt:
@@ -95,15 +100,15 @@ def GetDataflowStageLatencies(dataflow_rpt_filepath):
       for line in rpt:
          if "---" in line:
             break
-         tokens = re.split(r'\s*\|\s*', line)
+         tokens = RPT_COLUMN_SEP_RE.split(line)
          stage  = tokens[2]
          cycles = int(tokens[8])
          # Skip duplicate accumulation stages
-         if re.search('accum_\d_\d', stage) is not None or stage in stage_names:
+         if ACCUM_STAGE_RE.search(stage) is not None or stage in stage_names:
             continue
          if cycles > 0:
             stages.append({'name': stage, 'latency': cycles})
-            stage_names.append(stage)
+            stage_names.add(stage)
 
    longest_stage_cycles = max([s['latency'] for s in stages])
    dataflow_ii = longest_stage_cycles + 1 # Dataflow pipeline incurs 1 cycle overhead
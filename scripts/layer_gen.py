@@ -3,6 +3,7 @@
 # given its template and its specification
 from functools import reduce
 import copy
+import json
 import os
 import accum
 import math
@@ -368,7 +369,7 @@ def gen_axi_io_layer(layer_spec, odir, direction):
 
 
 # Create a file with a list of implementation directories.
-# It will be a text file where each line is a string representation of the 
+# It will be a text file where each line is a JSON representation of the 
 # dictionary that describes each implementation.
 def gen_layer_impl_list(odir, layer_spec, implementations):
    lname = layer_spec['layer_name']
@@ -377,12 +378,12 @@ def gen_layer_impl_list(odir, layer_spec, implementations):
    del_keys = ['accum_functions', 'accum_function_calls']
    latencies = []
    with open(fp, 'w') as f:
-      f.write(str(layer_spec) + "\n")
+      f.write(json.dumps(layer_spec) + "\n")
       for impl in implementations:
          latencies.append(impl['estimated_latency'])
          for k in del_keys:
             impl.pop(k, None)
-         f.write(str(impl))
+         f.write(json.dumps(impl))
          f.write("\n")
    in_dims = "{}x{}x{}".format(layer_spec['input_height'], \
                                layer_spec['input_width'],  \